@@ -1,59 +1,153 @@
 import asyncio
 import os
+import socket
 import struct
+import logging
+from astrbot.api import logger
 
-async def send_file(filename, HOST, PORT):
+# 回退路径的单次读取大小 (64 KiB)
+CHUNK = 1 << 16
+
+# 预编译的帧头格式
+_U32 = struct.Struct('>I')
+_U64 = struct.Struct('>Q')
+
+# socket 发送缓冲与 asyncio 写缓冲水位
+SNDBUF_SIZE = 1 << 20
+WRITE_HIGH_WATER = 1 << 20
+WRITE_LOW_WATER = 256 << 10
+
+# 不超过该大小的文件与帧头一次性写出
+SMALL_FILE_THRESHOLD = 256 << 10
+
+# 接收端在本机时可改走 Unix 域套接字
+_LOCAL_HOSTS = frozenset(('127.0.0.1', 'localhost', '::1'))
+
+def _open_for_send(filename):
+    """以顺序、一次性读取的方式打开待发送文件。"""
+    fd = os.open(filename, os.O_RDONLY)
+    if hasattr(os, 'posix_fadvise'):
+        # 提示内核顺序预读，且读完后不必保留页缓存
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+    return os.fdopen(fd, 'rb', buffering=0)
+
+def _readinto_exact(f, view):
+    """把文件内容读满 view，文件提前结束时报错。"""
+    while view:
+        n = f.readinto(view)
+        if not n:
+            raise EOFError("文件在发送过程中被截断")
+        view = view[n:]
+
+async def send_file(filename, HOST, PORT, unix_path=None):
+    writer = None
     try:
-        reader, writer = await asyncio.open_connection(HOST, PORT)
+        if unix_path and HOST in _LOCAL_HOSTS and hasattr(asyncio, 'open_unix_connection'):
+            # 同机传输：协议不变，省去 TCP 回环开销
+            reader, writer = await asyncio.open_unix_connection(unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(HOST, PORT)
+        sock = writer.get_extra_info('socket')
+        is_tcp = sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6)
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF_SIZE)
+        if is_tcp:
+            # 关闭 Nagle，避免小包写入 + 等待回复时的延迟确认卡顿
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
         file_name = os.path.basename(filename)
         file_name_bytes = file_name.encode('utf-8')
+        loop = asyncio.get_running_loop()
         
-        # 发送文件名长度和文件名
-        writer.write(struct.pack('>I', len(file_name_bytes)))
-        writer.write(file_name_bytes)
+        # 发送期间塞住 socket，帧头与内容攒成满 MSS 的报文段再发出
+        cork = is_tcp and hasattr(socket, 'TCP_CORK')
+        if cork:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
         
-        # 发送文件大小
-        file_size = os.path.getsize(filename)
-        writer.write(struct.pack('>Q', file_size))
-        
-        # 发送文件内容
-        await writer.drain()
-        with open(filename, 'rb') as f:
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                writer.write(data)
+        # 发送文件内容 (open/fadvise 在线程池中完成，不阻塞事件循环)
+        f = await loop.run_in_executor(None, _open_for_send, filename)
+        with f:
+            # 从已打开的 fd 取大小，与实际读取的内容保持一致
+            file_size = os.fstat(f.fileno()).st_size
+            
+            # 帧: 文件名长度 + 文件名 + 文件大小 [+ 小文件内容]，直接打包进同一块缓冲
+            name_len = len(file_name_bytes)
+            header_len = 4 + name_len + 8
+            small = file_size <= SMALL_FILE_THRESHOLD
+            frame = bytearray(header_len + file_size if small else header_len)
+            _U32.pack_into(frame, 0, name_len)
+            frame[4:4 + name_len] = file_name_bytes
+            _U64.pack_into(frame, 4 + name_len, file_size)
+            
+            if small:
+                # 小文件：内容直接读入帧尾，一次写出
+                with memoryview(frame) as mv:
+                    await loop.run_in_executor(None, _readinto_exact, f, mv[header_len:])
+                writer.write(frame)
                 await writer.drain()
-        print(f"文件 {file_name} 发送成功")
+            else:
+                # loop.sendfile 会先等待写缓冲清空，帧头无需单独 drain
+                writer.write(frame)
+                await _send_body(loop, writer, f, file_size)
+        if cork:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"文件 {file_name} 发送成功")
         
         # 接收接收端发送的文件绝对路径
         file_abs_path_len_data = await recv_all(reader, 4)
         if not file_abs_path_len_data:
-            print("无法接收文件绝对路径长度")
+            logger.warning("无法接收文件绝对路径长度")
             return
-        file_abs_path_len = struct.unpack('>I', file_abs_path_len_data)[0]
+        file_abs_path_len = _U32.unpack(file_abs_path_len_data)[0]
         
         file_abs_path_data = await recv_all(reader, file_abs_path_len)
         if not file_abs_path_data:
-            print("无法接收文件绝对路径")
+            logger.warning("无法接收文件绝对路径")
             return
         file_abs_path = file_abs_path_data.decode('utf-8')
-        print(f"接收端文件绝对路径: {file_abs_path}")
-        writer.close()
-        await writer.wait_closed()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"接收端文件绝对路径: {file_abs_path}")
         return file_abs_path
     except Exception as e:
-        print(f"传输失败: {e}")
+        logger.error(f"传输失败: {e}")
+    finally:
+        # 无论成功与否都关闭连接，避免失败时泄漏 socket
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+async def _send_body(loop, writer, f, file_size):
+    try:
+        # 零拷贝：由内核 sendfile(2) 直接把文件页送入 socket
+        await loop.sendfile(writer.transport, f, count=file_size, fallback=False)
+    except (asyncio.SendfileNotAvailableError, NotImplementedError):
+        # 不支持 sendfile (如 SSL 传输、uvloop 等未实现 sendfile 的事件循环) 时回退到逐块读写
+        transport = writer.transport
+        high_water = transport.get_write_buffer_limits()[1]
+        # 只发送头部声明的 file_size 字节，文件在 fstat 之后变化也不会破坏帧格式
+        remaining = file_size
+        while remaining > 0:
+            # 磁盘读取放到线程池，避免阻塞事件循环
+            data = await loop.run_in_executor(None, f.read, min(CHUNK, remaining))
+            if not data:
+                raise EOFError("文件在发送过程中被截断")
+            remaining -= len(data)
+            writer.write(data)
+            # 仅在写缓冲超过高水位时才让出事件循环
+            if transport.get_write_buffer_size() >= high_water:
+                await writer.drain()
+        await writer.drain()
 
 async def recv_all(reader, n):
-    data = bytearray()
-    while len(data) < n:
-        packet = await reader.read(n - len(data))
-        if not packet:
-            return None
-        data.extend(packet)
-    return data
+    try:
+        return await reader.readexactly(n)
+    except asyncio.IncompleteReadError:
+        return None
 
 # if __name__ == "__main__":
 #     file_path = input("请输入要发送的文件路径: ")
@@ -1,11 +1,44 @@
+import os
 import re
 import random
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+import aiohttp
 from astrbot.api.all import *
 from astrbot.api import logger
 from astrbot.api.event import filter, AstrMessageEvent
-from .ttp import generate_image, generate_video
+from .ttp import generate_image, close_session, _b64
 from astrbot.api.message_components import *
 
+# Fixed --ar l/p patterns (landscape/portrait listed first so the full word is stripped)
+_AR_LAND = re.compile(r'--ar\s+(landscape|l)', re.IGNORECASE)
+_AR_PORT = re.compile(r'--ar\s+(portrait|p)', re.IGNORECASE)
+
+# Config groups whose --ar / --res patterns are built from plugin config
+_CONFIG_GROUPS = ("openai_pro", "openai_normal", "nano_pro", "nano_normal")
+
+# Defaults when a config group doesn't list its allowed values
+_DEFAULT_AR = ("1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9")
+_DEFAULT_RES = ("1k", "2k", "4k")
+
+_QQ_AVATAR_TPL = "https://q1.qlogo.cn/g?b=qq&nk=%s&s=640"
+
+# QQ avatar cache: entries expire after an hour, at most 1024 kept
+_AVATAR_CACHE_TTL = 3600
+_AVATAR_CACHE_SIZE = 1024
+
+def _pop_orientation(prompt):
+    """Strip a --ar l/p flag in a single regex pass. Returns (orientation or None, prompt)."""
+    stripped, n = _AR_LAND.subn('', prompt)
+    if n:
+        return "landscape", stripped.strip()
+    stripped, n = _AR_PORT.subn('', prompt)
+    if n:
+        return "portrait", stripped.strip()
+    return None, prompt
+
 @register("pic-gen", "喵喵", "使用硅基流动api 让llm帮你画图", "0.0.2")
 class MyPlugin(Star):
     def __init__(self, context: Context,config: dict):
@@ -16,6 +49,12 @@ class MyPlugin(Star):
         self.group_white_list = config.get("group_white_list", [])
         self.user_white_list = config.get("user_white_list", [])
         self.ignore_at_qq_list = config.get("ignore_at_qq_list", [])
+        # 预先转换为字符串集合，避免每条消息重复构造列表并线性查找
+        self._user_white_set = frozenset(map(str, self.user_white_list))
+        self._group_white_set = frozenset(map(str, self.group_white_list))
+        self._ignore_at_set = frozenset(map(str, self.ignore_at_qq_list))
+        # No whitelist configured -> everyone is allowed
+        self._permission_open = not self.group_white_list and not self.user_white_list
         
         # API Configs
         self.openai_api_url = config.get("openai_api_url", "http://localhost:8317/v1/chat/completions")
@@ -32,146 +71,224 @@ class MyPlugin(Star):
         self.flow_model = config.get("flow_model", "gemini-2.5-flash-image")
         self.flowpro_model = config.get("flowpro_model", "gemini-3.0-pro-image")
         
-        # Round-Robin Counters
-        self.openai_idx = 0
-        self.flow_idx = 0
+        # Round-Robin token cycles
+        self._openai_cycle = itertools.cycle(self.openai_api_tokens) if self.openai_api_tokens else None
+        self._flow_cycle = itertools.cycle(self.flow_api_tokens) if self.flow_api_tokens else None
+
+        # Limit on concurrent image conversions / avatar downloads
+        self._image_fetch_sem = asyncio.Semaphore(8)
+
+        # qq_id -> (fetched_at, base64), LRU ordered
+        self._avatar_cache = OrderedDict()
+
+        # Shared HTTP session for avatar downloads (created lazily inside the event loop)
+        self._http_session = None
+
+        # llm_tool name -> provider, (model, config_group) for normal/pro, whether AR/Res are passed through
+        self._tool_specs = {
+            "pic-gen": {"provider": "openai", "normal": (self.openai_pro_model, "openai_pro"), "pro": (self.openai_pro_model, "openai_pro"), "supports_res": True},
+            "nano-gen": {"provider": "official", "normal": (self.nano_model, "nano_normal"), "pro": (self.nanopro_model, "nano_pro"), "supports_res": True},
+            "flow-gen": {"provider": "flow", "normal": (self.flow_model, None), "pro": (self.flowpro_model, None), "supports_res": False},
+        }
+
+        # Precompiled --ar / --res regexes per config group
+        self._ar_regex = {}
+        self._res_regex = {}
+        for cg in _CONFIG_GROUPS:
+            allowed_ars = config.get(f"{cg}_allowed_ars", _DEFAULT_AR)
+            allowed_res = config.get(f"{cg}_allowed_res", _DEFAULT_RES)
+            ar_pattern = "|".join([re.escape(ar) for ar in allowed_ars] + ["square", "landscape", "portrait"])
+            res_pattern = "|".join([re.escape(res) for res in allowed_res])
+            self._ar_regex[cg] = re.compile(r'--ar\s+(' + ar_pattern + r')', re.IGNORECASE)
+            self._res_regex[cg] = re.compile(r'--(' + res_pattern + r')', re.IGNORECASE)
+
+        # provider -> prompt flag parser used by _generate_core
+        self._prompt_parsers = {
+            "flow": self._parse_flow_prompt,
+            "openai": self._parse_openai_like_prompt,
+            "official": self._parse_openai_like_prompt,
+        }
+
+        # Rendered /生图help text, built on first use (set to None to rebuild)
+        self._help_cached = None
 
     def _check_permission(self, event: AstrMessageEvent) -> bool:
-        if not self.group_white_list and not self.user_white_list:
+        if self._permission_open:
             return True
         
-        user_id = event.message_obj.sender.user_id
-        if self.user_white_list and str(user_id) in [str(uid) for uid in self.user_white_list]:
+        msg_obj = getattr(event, 'message_obj', None)
+        sender = getattr(msg_obj, 'sender', None)
+        if sender is not None and str(sender.user_id) in self._user_white_set:
             return True
             
-        group_id = None
-        if hasattr(event, 'message_obj') and event.message_obj:
-            group_id = getattr(event.message_obj, 'group_id', None)
-            
-        if group_id and self.group_white_list:
-            if str(group_id) in [str(gid) for gid in self.group_white_list]:
-                return True
+        group_id = getattr(msg_obj, 'group_id', None)
+        if group_id and str(group_id) in self._group_white_set:
+            return True
 
         return False
         
     def _get_next_api(self, api_type="openai"):
         """Get next API config (URL, Token) using Round-Robin for Tokens"""
         if api_type == "openai":
-            if not self.openai_api_tokens: return self.openai_api_url, None
-            token = self.openai_api_tokens[self.openai_idx % len(self.openai_api_tokens)]
-            self.openai_idx += 1
+            token = next(self._openai_cycle) if self._openai_cycle else None
             return self.openai_api_url, token
         elif api_type == "flow":
-            if not self.flow_api_tokens: return self.flow_api_url, None
-            token = self.flow_api_tokens[self.flow_idx % len(self.flow_api_tokens)]
-            self.flow_idx += 1
+            token = next(self._flow_cycle) if self._flow_cycle else None
             return self.flow_api_url, token
         return None, None
+
+    def _extract_prompt(self, event: AstrMessageEvent, cmd: str, default: str = "") -> str:
+        """Get the full prompt text after the command, falling back to the parsed argument."""
+        full_text = "".join(comp.text for comp in event.message_obj.message if type(comp) is Plain)
+        # Finding "cmd" also covers "/cmd"; slice past it without split()'s list allocation
+        i = full_text.find(cmd)
+        return full_text[i + len(cmd):].strip() if i >= 0 else default
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        if self._http_session is None or self._http_session.closed:
+            # Keep-alive pool so repeated avatar fetches skip the TCP/TLS handshake
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=16, keepalive_timeout=60)
+            self._http_session = aiohttp.ClientSession(connector=connector)
+        return self._http_session
+
+    async def _download_b64(self, url: str) -> str:
+        """Download url over the pooled session and return its base64 encoding."""
+        async with self._get_http_session().get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.read()
+        return _b64.b64encode(data).decode('ascii')
+
+    async def _get_avatar_b64(self, qq_id: str):
+        """Fetch a QQ avatar as base64, served from an LRU+TTL cache when possible."""
+        now = time.monotonic()
+        cached = self._avatar_cache.get(qq_id)
+        if cached and now - cached[0] < _AVATAR_CACHE_TTL:
+            self._avatar_cache.move_to_end(qq_id)
+            return cached[1]
+
+        base64_data = await self._download_b64(_QQ_AVATAR_TPL % qq_id)
+        if base64_data:
+            self._avatar_cache[qq_id] = (now, base64_data)
+            self._avatar_cache.move_to_end(qq_id)
+            while len(self._avatar_cache) > _AVATAR_CACHE_SIZE:
+                self._avatar_cache.popitem(last=False)
+        return base64_data
+
     async def _get_event_images(self, event: AstrMessageEvent, include_sender_avatar: bool = False) -> list[str]:
         """Extract images from event (message, quoted message, @mention avatar, and optional sender avatar)."""
-        input_images_b64 = []
-        
-        # Helper to process a list of components
-        async def process_chain(chain):
-            for comp in chain:
-                if isinstance(comp, Image):
-                    try:
-                        base64_data = await comp.convert_to_base64()
-                        input_images_b64.append(base64_data)
-                    except Exception as e:
-                        logger.warning(f"Failed to convert image to base64: {e}")
-
-        # 1. Current message images
-        if hasattr(event, 'message_obj') and event.message_obj and hasattr(event.message_obj, 'message'):
-            await process_chain(event.message_obj.message)
-            
-            # 2. Quoted message (Reply) images
-            for comp in event.message_obj.message:
-                if isinstance(comp, Reply) and comp.chain:
-                    await process_chain(comp.chain)
-
-        # 3. @Mention Avatars (Appended last)
-        if hasattr(event, 'message_obj') and event.message_obj and hasattr(event.message_obj, 'message'):
-            for comp in event.message_obj.message:
-                if isinstance(comp, At):
-                    try:
-                        qq_id = str(comp.qq)
-                        # Check ignore list (convert all to strings for comparison)
-                        ignore_list = [str(x) for x in self.ignore_at_qq_list]
-                        
-                        if qq_id and qq_id not in ignore_list:
-                            avatar_url = f"https://q1.qlogo.cn/g?b=qq&nk={qq_id}&s=640"
-                            # Use Image.fromURL to download and convert
-                            img_obj = Image.fromURL(avatar_url)
-                            base64_data = await img_obj.convert_to_base64()
-                            if base64_data:
-                                input_images_b64.append(base64_data)
-                    except Exception as e:
-                        logger.warning(f"Failed to fetch avatar for {comp.qq}: {e}")
+        # Results are memoized on the event so repeated calls don't redo conversions/downloads
+        cache = getattr(event, '_llm_draw_img_cache', None)
+        if cache is None:
+            cache = {}
+            setattr(event, '_llm_draw_img_cache', cache)
+        elif include_sender_avatar in cache:
+            return list(cache[include_sender_avatar])
+
+        # Jobs are (coroutine, failure message) pairs, collected in output order and awaited concurrently
+        async def limited(coro_fn, *args):
+            # Cap concurrent downloads/conversions
+            async with self._image_fetch_sem:
+                return await coro_fn(*args)
+
+        async def convert(comp):
+            return await comp.convert_to_base64()
+
+        msg_obj = getattr(event, 'message_obj', None)
+        chain = getattr(msg_obj, 'message', None) if msg_obj else None
+
+        # Single pass over the message; per-source lists keep the output order:
+        # 1. current message images, 2. quoted (Reply) images, 3. @mention avatars
+        image_jobs, reply_jobs, at_jobs = [], [], []
+        # Exact type checks: message components are concrete classes (switch back to isinstance if subclassed)
+        for comp in chain or ():
+            t = type(comp)
+            if t is Image:
+                image_jobs.append((limited(convert, comp), "Failed to convert image to base64"))
+            elif t is Reply:
+                for sub in comp.chain or ():
+                    if type(sub) is Image:
+                        reply_jobs.append((limited(convert, sub), "Failed to convert image to base64"))
+            elif t is At:
+                qq_id = str(comp.qq)
+                # Check ignore list (precomputed string set)
+                if qq_id and qq_id not in self._ignore_at_set:
+                    at_jobs.append((limited(self._get_avatar_b64, qq_id), f"Failed to fetch avatar for {comp.qq}"))
+        jobs = image_jobs + reply_jobs + at_jobs
         
         # 4. Sender Avatar (if requested)
         if include_sender_avatar:
             try:
-                sender_id = event.message_obj.sender.user_id
+                sender_id = msg_obj.sender.user_id
                 if sender_id:
-                     avatar_url = f"https://q1.qlogo.cn/g?b=qq&nk={sender_id}&s=640"
-                     img_obj = Image.fromURL(avatar_url)
-                     base64_data = await img_obj.convert_to_base64()
-                     if base64_data:
-                         input_images_b64.append(base64_data)
+                    jobs.append((limited(self._get_avatar_b64, str(sender_id)), "Failed to fetch sender avatar"))
             except Exception as e:
                 logger.warning(f"Failed to fetch sender avatar: {e}")
 
-        return input_images_b64
+        if not jobs:
+            cache[include_sender_avatar] = []
+            return []
+
+        results = await asyncio.gather(*(coro for coro, _ in jobs), return_exceptions=True)
+
+        input_images_b64 = []
+        for (_, failure_msg), result in zip(jobs, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"{failure_msg}: {result}")
+            elif result:
+                input_images_b64.append(result)
+        cache[include_sender_avatar] = input_images_b64
+        return list(input_images_b64)
+
+    def _parse_flow_prompt(self, prompt, config_group, aspect_ratio, resolution):
+        """Flow2API: Only l/p; resolution is not supported."""
+        orientation, prompt = _pop_orientation(prompt)
+        if orientation:
+            aspect_ratio = orientation
+        return prompt, aspect_ratio, resolution
+
+    def _parse_openai_like_prompt(self, prompt, config_group, aspect_ratio, resolution):
+        """OpenAI compatible / official API: --ar and --res flags per config group."""
+        if not config_group:
+            return prompt, aspect_ratio, resolution
+
+        # Load specific config for this command group
+        enable_ar = self.config.get(f"{config_group}_enable_ar", True)
+        enable_res = self.config.get(f"{config_group}_enable_res", False)
+
+        # 只在 aspect_ratio 未传入时才从 prompt 解析
+        if enable_ar and not aspect_ratio:
+            # Regex precompiled from allowed_ars
+            ar_match = self._ar_regex[config_group].search(prompt)
+            
+            if ar_match:
+                aspect_ratio = ar_match.group(1)
+                prompt = prompt.replace(ar_match.group(0), "").strip()
+            
+            # Support --ar l/p mapping for convenience if enabled
+            if not aspect_ratio:
+                orientation, prompt = _pop_orientation(prompt)
+                if orientation == "landscape":
+                    aspect_ratio = "16:9" # Default landscape
+                elif orientation == "portrait":
+                    aspect_ratio = "9:16" # Default portrait
+
+        # 只在 resolution 未传入时才从 prompt 解析
+        if enable_res and not resolution:
+            # Regex precompiled from allowed_resolutions
+            res_match = self._res_regex[config_group].search(prompt)
+            if res_match:
+                resolution = res_match.group(1).upper()
+                prompt = prompt.replace(res_match.group(0), "").strip()
+        return prompt, aspect_ratio, resolution
 
     async def _generate_core(self, event, prompt, model_name, provider="flow", config_group=None, aspect_ratio=None, resolution=None, input_images_b64=None):
         """Core logic for image generation."""
         action = "改图" if input_images_b64 else "生图"
         
-        # 参数解析 logic moved from _handle_gen_image
-        if provider == "flow":
-            # Flow2API: Only l/p
-            if "--ar l" in prompt.lower():
-                aspect_ratio = "landscape"
-                prompt = re.sub(r'--ar\s+l', '', prompt, flags=re.IGNORECASE).strip()
-            elif "--ar p" in prompt.lower():
-                aspect_ratio = "portrait"
-                prompt = re.sub(r'--ar\s+p', '', prompt, flags=re.IGNORECASE).strip()
-            
-        elif (provider == "openai" or provider == "official") and config_group:
-            # Load specific config for this command group
-            enable_ar = self.config.get(f"{config_group}_enable_ar", True)
-            allowed_ars = self.config.get(f"{config_group}_allowed_ars", ["1:1","2:3","3:2","3:4","4:3","4:5","5:4","9:16","16:9","21:9"])
-            enable_res = self.config.get(f"{config_group}_enable_res", False)
-            allowed_res = self.config.get(f"{config_group}_allowed_res", ["1k", "2k", "4k"])
-
-            # 只在 aspect_ratio 未传入时才从 prompt 解析
-            if enable_ar and not aspect_ratio:
-                # Build regex from allowed_ars
-                ar_pattern = "|".join([re.escape(ar) for ar in allowed_ars] + ["square", "landscape", "portrait"])
-                ar_match = re.search(r'--ar\s+(' + ar_pattern + r')', prompt, re.IGNORECASE)
-                
-                if ar_match:
-                    aspect_ratio = ar_match.group(1)
-                    prompt = prompt.replace(ar_match.group(0), "").strip()
-                
-                # Support --ar l/p mapping for convenience if enabled
-                if not aspect_ratio:
-                    if "--ar l" in prompt.lower():
-                        aspect_ratio = "16:9" # Default landscape
-                        prompt = re.sub(r'--ar\s+l', '', prompt, flags=re.IGNORECASE).strip()
-                    elif "--ar p" in prompt.lower():
-                        aspect_ratio = "9:16" # Default portrait
-                        prompt = re.sub(r'--ar\s+p', '', prompt, flags=re.IGNORECASE).strip()
-
-            # 只在 resolution 未传入时才从 prompt 解析
-            if enable_res and not resolution:
-                # Build regex from allowed_resolutions
-                res_pattern = "|".join([re.escape(res) for res in allowed_res])
-                res_match = re.search(r'--(' + res_pattern + r')', prompt, re.IGNORECASE)
-                if res_match:
-                    resolution = res_match.group(1).upper()
-                    prompt = prompt.replace(res_match.group(0), "").strip()
+        # 参数解析 logic moved from _handle_gen_image (per-provider parser)
+        parser = self._prompt_parsers.get(provider)
+        if parser:
+            prompt, aspect_ratio, resolution = parser(prompt, config_group, aspect_ratio, resolution)
         
         google_api_key = self.google_api_key
 
@@ -182,11 +299,11 @@ class MyPlugin(Star):
         if provider == "openai":
             current_api_url, current_api_token = self._get_next_api("openai")
             if not current_api_url:
-                return False, f"❌ 未配置 OpenAI 兼容 API URL (openai_api_url)。", None, None
+                return False, f"❌ 未配置 OpenAI 兼容 API URL (openai_api_url)。", None, None, None
         elif provider == "flow":
             current_api_url, current_api_token = self._get_next_api("flow")
             if not current_api_url:
-                return False, f"❌ 未配置 Flow API URL (flow_api_url)。", None, None
+                return False, f"❌ 未配置 Flow API URL (flow_api_url)。", None, None, None
 
         image_url, image_path, source = await generate_image(
             prompt,
@@ -201,19 +318,33 @@ class MyPlugin(Star):
         )
         
         if not image_url and not image_path:
-            return False, f"{action}失败，未知错误。", None, None
+            return False, f"{action}失败，未知错误。", None, None, None
         if image_path and image_path.startswith("Error:"):
-            return False, f"{action}失败: {image_path}", None, None
+            return False, f"{action}失败: {image_path}", None, None, None
 
         chain = []
         if image_url:
+            # 发送 URL 时本地副本只用于探测尺寸，立即删除
+            self._discard_image(image_path)
             chain = [Image.fromURL(image_url)]
+            image_path = None
         elif image_path:
             chain = [Image.fromFileSystem(image_path)]
         else:
-            return False, f"{action}失败。", None, None
+            return False, f"{action}失败。", None, None, None
             
-        return True, "Success", chain, source
+        # image_path 由调用方在发送后删除
+        return True, "Success", chain, source, image_path
+
+    @staticmethod
+    def _discard_image(image_path):
+        """Remove a generated image file once it is no longer needed."""
+        if image_path:
+            try:
+                os.remove(image_path)
+            except OSError:
+                pass
+
 
     async def _handle_gen_image(self, event, prompt, model_name, provider="flow", config_group=None):
         """Helper for image generation handling (Generator for Commands)"""
@@ -227,7 +358,7 @@ class MyPlugin(Star):
         action = "改图" if input_images_b64 else "生图"
         yield event.plain_result(f"正在{action} ({provider} - {config_group if config_group else 'Flow'})... Prompt: {prompt}")
 
-        success, msg, chain, source = await self._generate_core(event, prompt, model_name, provider, config_group, input_images_b64=input_images_b64)
+        success, msg, chain, source, image_path = await self._generate_core(event, prompt, model_name, provider, config_group, input_images_b64=input_images_b64)
 
         if not success:
             yield event.plain_result(msg)
@@ -235,7 +366,41 @@ class MyPlugin(Star):
         
         if source:
             yield event.plain_result(f"✅ 使用模型: {source}")
-        yield event.chain_result(chain)
+        try:
+            yield event.chain_result(chain)
+        finally:
+            self._discard_image(image_path)
+
+    async def _dispatch_tool(self, tool_name, event, prompt, aspect_ratio=None, resolution=None, is_pro=False, use_sender_avatar=False) -> str:
+        """Shared body of the image llm_tools, driven by self._tool_specs."""
+        spec = self._tool_specs[tool_name]
+        model, config_group = spec["pro" if is_pro else "normal"]
+
+        # 自动提取图片 (Current + Quote + Mention + Sender)
+        input_images_b64 = await self._get_event_images(event, include_sender_avatar=use_sender_avatar)
+
+        if spec["supports_res"]:
+            # 直接传递 aspect_ratio 和 resolution 参数，而不是追加到 prompt
+            success, msg, chain, source, image_path = await self._generate_core(
+                event, prompt, model, provider=spec["provider"], config_group=config_group,
+                aspect_ratio=aspect_ratio, resolution=resolution,
+                input_images_b64=input_images_b64
+            )
+            detail = f" AR: {aspect_ratio}, Res: {resolution}."
+        else:
+            # Flow only understands --ar l/p inside the prompt
+            if aspect_ratio: prompt += f" --ar {aspect_ratio}"
+            success, msg, chain, source, image_path = await self._generate_core(event, prompt, model, provider=spec["provider"], input_images_b64=input_images_b64)
+            detail = ""
+
+        if not success:
+            return f"Image generation failed: {msg}"
+        try:
+            await event.send(event.chain_result(chain))
+        finally:
+            self._discard_image(image_path)
+        ref_msg = f" using {len(input_images_b64)} reference image(s)" if input_images_b64 else ""
+        return f"Image generated successfully{ref_msg}. Model: {source}.{detail} Prompt: {prompt}"
 
     @llm_tool(name="pic-gen")
     async def pic_gen(self, event: AstrMessageEvent, prompt: str = "", aspect_ratio: str = None, resolution: str = None, is_pro: bool = False, use_sender_avatar: bool = False) -> str:
@@ -249,24 +414,7 @@ class MyPlugin(Star):
             is_pro (bool): Set to True if user requests "high quality", "4k", "pro" model. Default True.
             use_sender_avatar (bool): Set to True if user refers to "me", "my avatar", "self", or "I" as the reference image.
         """
-        model = self.openai_pro_model
-        config_group = "openai_pro"
-
-        # 自动提取图片 (Current + Quote + Mention + Sender)
-        input_images_b64 = await self._get_event_images(event, include_sender_avatar=use_sender_avatar)
-
-        # 直接传递 aspect_ratio 和 resolution 参数，而不是追加到 prompt
-        success, msg, chain, source = await self._generate_core(
-            event, prompt, model, provider="openai", config_group=config_group,
-            aspect_ratio=aspect_ratio, resolution=resolution,
-            input_images_b64=input_images_b64
-        )
-        if success:
-            await event.send(event.chain_result(chain))
-            ref_msg = f" using {len(input_images_b64)} reference image(s)" if input_images_b64 else ""
-            return f"Image generated successfully{ref_msg}. Model: {source}. AR: {aspect_ratio}, Res: {resolution}. Prompt: {prompt}"
-        else:
-            return f"Image generation failed: {msg}"
+        return await self._dispatch_tool("pic-gen", event, prompt, aspect_ratio, resolution, is_pro, use_sender_avatar)
 
     @llm_tool(name="nano-gen")
     async def nano_gen(self, event: AstrMessageEvent, prompt: str = "", aspect_ratio: str = None, resolution: str = None, is_pro: bool = False, use_sender_avatar: bool = False) -> str:
@@ -280,24 +428,7 @@ class MyPlugin(Star):
             is_pro (bool): Set to True if user requests "high quality", "4k", "pro" model. Default False.
             use_sender_avatar (bool): Set to True if user refers to "me", "my avatar", "self", or "I" as the reference image.
         """
-        model = self.nanopro_model if is_pro else self.nano_model
-        config_group = "nano_pro" if is_pro else "nano_normal"
-        
-        # 自动提取图片
-        input_images_b64 = await self._get_event_images(event, include_sender_avatar=use_sender_avatar)
-
-        # 直接传递 aspect_ratio 和 resolution 参数
-        success, msg, chain, source = await self._generate_core(
-            event, prompt, model, provider="official", config_group=config_group,
-            aspect_ratio=aspect_ratio, resolution=resolution,
-            input_images_b64=input_images_b64
-        )
-        if success:
-            await event.send(event.chain_result(chain))
-            ref_msg = f" using {len(input_images_b64)} reference image(s)" if input_images_b64 else ""
-            return f"Image generated successfully{ref_msg}. Model: {source}. AR: {aspect_ratio}, Res: {resolution}. Prompt: {prompt}"
-        else:
-            return f"Image generation failed: {msg}"
+        return await self._dispatch_tool("nano-gen", event, prompt, aspect_ratio, resolution, is_pro, use_sender_avatar)
 
     @llm_tool(name="flow-gen")
     async def flow_gen(self, event: AstrMessageEvent, prompt: str = "", aspect_ratio: str = "landscape", is_pro: bool = False, use_sender_avatar: bool = False) -> str:
@@ -310,21 +441,7 @@ class MyPlugin(Star):
             is_pro (bool): Set to True if user requests "pro" model. Default False.
             use_sender_avatar (bool): Set to True if user refers to "me", "my avatar", "self", or "I" as the reference image.
         """
-        full_prompt = prompt
-        if aspect_ratio: full_prompt += f" --ar {aspect_ratio}"
-        
-        model = self.flowpro_model if is_pro else self.flow_model
-        
-        # 自动提取图片
-        input_images_b64 = await self._get_event_images(event, include_sender_avatar=use_sender_avatar)
-
-        success, msg, chain, source = await self._generate_core(event, full_prompt, model, provider="flow", input_images_b64=input_images_b64)
-        if success:
-            await event.send(event.chain_result(chain))
-            ref_msg = f" using {len(input_images_b64)} reference image(s)" if input_images_b64 else ""
-            return f"Image generated successfully{ref_msg}. Model: {source}. Prompt: {full_prompt}"
-        else:
-            return f"Image generation failed: {msg}"
+        return await self._dispatch_tool("flow-gen", event, prompt, aspect_ratio, None, is_pro, use_sender_avatar)
 
     @llm_tool(name="veo-gen")
     async def veo_gen(self, event: AstrMessageEvent, prompt: str = "", aspect_ratio: str = "landscape", use_sender_avatar: bool = False) -> str:
@@ -360,6 +477,9 @@ class MyPlugin(Star):
 
         await event.send(event.plain_result(f"正在生成视频 (Veo - {ar_param})... Prompt: {prompt}"))
 
+        # Video support is imported on first use
+        from .ttp import generate_video
+
         try:
             video_url, error_msg, source = await generate_video(
                 prompt,
@@ -400,10 +520,7 @@ class MyPlugin(Star):
     @filter.command("生图pro")
     async def cmd_gen_image_openai_pro(self, event: AstrMessageEvent, prompt: str = ""):
         """(OpenAI Compatible) 使用配置的 openai_pro_model 生图。"""
-        texts = [comp.text for comp in event.message_obj.message if isinstance(comp, Plain)]
-        full_text = "".join(texts).strip()
-        if "/生图pro" in full_text: prompt = full_text.split("/生图pro", 1)[1].strip()
-        elif "生图pro" in full_text: prompt = full_text.split("生图pro", 1)[1].strip()
+        prompt = self._extract_prompt(event, "生图pro", prompt)
 
         async for result in self._handle_gen_image(event, prompt, self.openai_pro_model, provider="openai", config_group="openai_pro"):
             yield result
@@ -411,10 +528,7 @@ class MyPlugin(Star):
     @filter.command("nano")
     async def cmd_gen_image_nano(self, event: AstrMessageEvent, prompt: str = ""):
         """(官方API) 使用配置的 nano_model 生图。"""
-        texts = [comp.text for comp in event.message_obj.message if isinstance(comp, Plain)]
-        full_text = "".join(texts).strip()
-        if "/nano" in full_text: prompt = full_text.split("/nano", 1)[1].strip()
-        elif "nano" in full_text: prompt = full_text.split("nano", 1)[1].strip()
+        prompt = self._extract_prompt(event, "nano", prompt)
 
         async for result in self._handle_gen_image(event, prompt, self.nano_model, provider="official", config_group="nano_normal"):
             yield result
@@ -422,10 +536,7 @@ class MyPlugin(Star):
     @filter.command("nanopro")
     async def cmd_gen_image_nanopro(self, event: AstrMessageEvent, prompt: str = ""):
         """(官方API) 使用配置的 nanopro_model 生图。"""
-        texts = [comp.text for comp in event.message_obj.message if isinstance(comp, Plain)]
-        full_text = "".join(texts).strip()
-        if "/nanopro" in full_text: prompt = full_text.split("/nanopro", 1)[1].strip()
-        elif "nanopro" in full_text: prompt = full_text.split("nanopro", 1)[1].strip()
+        prompt = self._extract_prompt(event, "nanopro", prompt)
 
         async for result in self._handle_gen_image(event, prompt, self.nanopro_model, provider="official", config_group="nano_pro"):
             yield result
@@ -433,10 +544,7 @@ class MyPlugin(Star):
     @filter.command("flow")
     async def cmd_gen_image_flow(self, event: AstrMessageEvent, prompt: str = ""):
         """(Flow2API) 使用配置的 flow_model 生图。参数: --ar l (横屏) / --ar p (竖屏)。"""
-        texts = [comp.text for comp in event.message_obj.message if isinstance(comp, Plain)]
-        full_text = "".join(texts).strip()
-        if "/flow" in full_text: prompt = full_text.split("/flow", 1)[1].strip()
-        elif "flow" in full_text: prompt = full_text.split("flow", 1)[1].strip()
+        prompt = self._extract_prompt(event, "flow", prompt)
         
         async for result in self._handle_gen_image(event, prompt, self.flow_model, provider="flow"):
             yield result
@@ -444,10 +552,7 @@ class MyPlugin(Star):
     @filter.command("flowpro")
     async def cmd_gen_image_flow_pro(self, event: AstrMessageEvent, prompt: str = ""):
         """(Flow2API) 使用配置的 flowpro_model 生图。参数: --ar l (横屏) / --ar p (竖屏)。"""
-        texts = [comp.text for comp in event.message_obj.message if isinstance(comp, Plain)]
-        full_text = "".join(texts).strip()
-        if "/flowpro" in full_text: prompt = full_text.split("/flowpro", 1)[1].strip()
-        elif "flowpro" in full_text: prompt = full_text.split("flowpro", 1)[1].strip()
+        prompt = self._extract_prompt(event, "flowpro", prompt)
         
         async for result in self._handle_gen_image(event, prompt, self.flowpro_model, provider="flow"):
             yield result
@@ -466,36 +571,14 @@ class MyPlugin(Star):
              return
 
         # 手动提取完整 prompt
-        texts = []
-        for comp in event.message_obj.message:
-            if isinstance(comp, Plain):
-                texts.append(comp.text)
-        
-        full_text = "".join(texts).strip()
-        
-        if "/生视频" in full_text:
-            prompt = full_text.split("/生视频", 1)[1].strip()
-        elif "生视频" in full_text:
-            prompt = full_text.split("生视频", 1)[1].strip()
-            
-            prompt = full_text.split("生视频", 1)[1].strip()
-            
+        prompt = self._extract_prompt(event, "生视频", prompt)
+
         # 提取图片 - Current + Quote
         input_images_b64 = await self._get_event_images(event)
 
         # Flow2API Video AR: --ar l / p
-        aspect_ratio = "landscape" # Default
-        
-        # Enhanced AR parsing
-        ar_match_l = re.search(r'--ar\s+(l|landscape)', prompt, re.IGNORECASE)
-        ar_match_p = re.search(r'--ar\s+(p|portrait)', prompt, re.IGNORECASE)
-        
-        if ar_match_p:
-            aspect_ratio = "portrait"
-            prompt = prompt.replace(ar_match_p.group(0), "").strip()
-        elif ar_match_l:
-            aspect_ratio = "landscape"
-            prompt = prompt.replace(ar_match_l.group(0), "").strip()
+        orientation, prompt = _pop_orientation(prompt)
+        aspect_ratio = orientation or "landscape" # Default landscape
 
         # 确定模型
         model = "veo_3_1_t2v_fast" # 默认文生视频
@@ -508,6 +591,9 @@ class MyPlugin(Star):
         else:
             yield event.plain_result(f"正在生成视频 (文生视频模式 - {aspect_ratio})... Prompt: {prompt}")
 
+        # Video support is imported on first use
+        from .ttp import generate_video
+
         try:
             video_url, error_msg, source = await generate_video(
                 prompt,
@@ -531,9 +617,8 @@ class MyPlugin(Star):
         if source:
             yield event.plain_result(f"✅ 使用模型: {source}")
 
-    @filter.command("生图help")
-    async def cmd_image_help(self, event: AstrMessageEvent):
-        """显示生图插件的帮助信息"""
+    def _build_help(self) -> str:
+        """Render the /生图help text. Config is static after init, so the result is cached."""
         # Helper to format list or show "不支持"
         def fmt(enabled, items):
             return ', '.join(items) if enabled else '不支持'
@@ -570,4 +655,17 @@ class MyPlugin(Star):
             "  参数: `--ar l` (横屏), `--ar p` (竖屏)\n"
             "  支持附带图片进行图生视频或首尾帧生成。"
         )
-        yield event.plain_result(help_msg)
\ No newline at end of file
+        return help_msg
+
+    @filter.command("生图help")
+    async def cmd_image_help(self, event: AstrMessageEvent):
+        """显示生图插件的帮助信息"""
+        if self._help_cached is None:
+            self._help_cached = self._build_help()
+        yield event.plain_result(self._help_cached)
+
+    async def terminate(self):
+        """Close the shared HTTP sessions when the plugin is unloaded."""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        await close_session()
@@ -1,9 +1,245 @@
 import json
-import requests
 import asyncio
 import aiohttp
+import aiofiles
+import gzip
+import ipaddress
 import os
+import shutil
+import uuid
+from urllib.parse import urlparse
+from yarl import URL
 
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，缺失时退回标准库
+    orjson = None
+
+
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_GZIP_JSON_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+# 设置 COMFYUI_GZIP_SUBMIT=1 时压缩提交的工作流；不支持的端点会被记录并改发明文
+_GZIP_SUBMIT = os.environ.get("COMFYUI_GZIP_SUBMIT") == "1"
+_NO_GZIP_ENDPOINTS = set()
+
+
+# 进程内共享的 HTTP 会话，提交、轮询和下载复用同一组 keep-alive 连接
+_SESSION = None
+_SESSION_LOCK = asyncio.Lock()
+
+
+async def _get_session():
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        async with _SESSION_LOCK:
+            if _SESSION is None or _SESSION.closed:
+                connector = aiohttp.TCPConnector(limit=32, keepalive_timeout=60, enable_cleanup_closed=True)
+                _SESSION = aiohttp.ClientSession(connector=connector, read_bufsize=1 << 20)
+    return _SESSION
+
+
+async def close_session():
+    """关闭共享会话 (插件卸载/进程退出时调用)。"""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
+
+async def warmup(comfyui_endpoint: str) -> bool:
+    """
+    预热到 ComfyUI 的连接 (DNS 解析 + TCP/TLS 握手)，使首个任务直接复用连接池。
+
+    在启动时调用一次即可，失败不影响后续任务。
+    """
+    session = await _get_session()
+    try:
+        async with session.get(f"{comfyui_endpoint}/system_stats") as response:
+            await response.read()
+            return response.status == 200
+    except aiohttp.ClientError as e:
+        print(f"ComfyUI 预热失败: {e}")
+        return False
+
+
+# 各网络步骤的超时，避免 ComfyUI 卡死时协程和连接被永久占用
+_SUBMIT_TIMEOUT = aiohttp.ClientTimeout(total=10)
+_POLL_TIMEOUT = aiohttp.ClientTimeout(total=5)
+_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=120)
+_WS_CONNECT_TIMEOUT = 10
+
+
+class _ServerError(Exception):
+    """ComfyUI 返回 5xx，可重试。"""
+
+
+_TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError, _ServerError)
+# POST /prompt 不是幂等的：请求一旦发出就可能已入队，只有连接没建立起来时才能安全重发
+_CONNECT_ERRORS = (aiohttp.ClientConnectorError,)
+
+
+async def _retry(factory, tries=3, base=0.2, retry_on=_TRANSIENT_ERRORS):
+    """对 retry_on 中的错误 (默认: 连接失败、超时、5xx) 按指数退避重试 factory()。"""
+    for i in range(tries):
+        try:
+            return await factory()
+        except retry_on as e:
+            if i == tries - 1:
+                raise
+            print(f"请求失败，{base * 2 ** i:.1f} 秒后重试: {e!r}")
+            await asyncio.sleep(base * 2 ** i)
+
+
+# 已解析的工作流模板: 路径 -> (st_mtime_ns, 模板, 节点 14 的 inputs, 节点 17 的 inputs)
+# 每个路径只保留一份，文件修改后旧模板会被替换掉
+_WF_CACHE = {}
+
+
+async def _wait_ws_done(ws, prompt_id):
+    """等待 ComfyUI 推送 prompt_id 执行结束 (executing 且 node 为空) 或出错的事件。"""
+    try:
+        async for msg in ws:
+            # 二进制帧是预览图，忽略
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            event = _json_loads(msg.data)
+            data = event.get("data") or {}
+            if data.get("prompt_id") != prompt_id:
+                continue
+            if event.get("type") == "execution_error":
+                return
+            if event.get("type") == "executing" and data.get("node") is None:
+                return
+    except aiohttp.ClientError as e:
+        print(f"WebSocket 中断，改为轮询: {e}")
+
+
+async def _poll_history(session, endpoint, prompt_id):
+    """轮询 /history 直到任务完成，间隔从 0.2 秒指数增长到 2 秒。"""
+    delay = 0.2
+    url = f"{endpoint}/history/{prompt_id}"
+    # 内容未变化时跳过 JSON 解析: 服务器支持 ETag 则发条件请求，否则比较响应体
+    etag = None
+    last_body = None
+    while True:
+        headers = {"If-None-Match": etag} if etag else None
+        try:
+            async with session.get(url, headers=headers, timeout=_POLL_TIMEOUT) as poll_response:
+                if poll_response.status == 200:
+                    etag = poll_response.headers.get("ETag")
+                    body = await poll_response.read()
+                    if body != last_body:
+                        last_body = body
+                        poll_data = _json_loads(body)
+                        status = poll_data.get(prompt_id, {}).get("status", {})
+                        if status.get("completed", False):
+                            return poll_data
+                        if status.get("status_str") == "error":
+                            raise Exception(f"任务执行失败: {status}")
+        except _TRANSIENT_ERRORS as e:
+            # 单次轮询失败不致命，下一轮重试
+            print(f"轮询失败: {e!r}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+
+
+async def _submit(session, endpoint, payload):
+    """提交工作流，返回 prompt_id。"""
+    # 工作流 JSON 重复键多，gzip 后通常缩小数倍；服务器不接受时记住并退回明文
+    if _GZIP_SUBMIT and endpoint not in _NO_GZIP_ENDPOINTS:
+        status, body = await _post_prompt(session, endpoint, gzip.compress(payload, 1), _GZIP_JSON_HEADERS)
+        if status in (400, 415):
+            _NO_GZIP_ENDPOINTS.add(endpoint)
+        else:
+            return _check_submit(status, body)
+    status, body = await _post_prompt(session, endpoint, payload, _JSON_HEADERS)
+    return _check_submit(status, body)
+
+
+async def _post_prompt(session, endpoint, data, headers):
+    async with session.post(
+        f"{endpoint}/prompt",
+        data=data,
+        headers=headers,
+        timeout=_SUBMIT_TIMEOUT
+    ) as response:
+        return response.status, await response.read()
+
+
+def _check_submit(status, body):
+    if status >= 500:
+        raise _ServerError(f"提交工作流失败 ({status}): {body.decode('utf-8', 'replace')}")
+    if status != 200:
+        raise Exception(f"提交工作流失败: {body.decode('utf-8', 'replace')}")
+    return _json_loads(body)["prompt_id"]
+
+
+async def _download(session, url, output_file):
+    """下载文件并边收边写入磁盘。"""
+    async with session.get(url, timeout=_DOWNLOAD_TIMEOUT) as response:
+        if response.status >= 500:
+            raise _ServerError(f"下载音频文件失败 ({response.status}): {await response.text()}")
+        if response.status != 200:
+            raise Exception(f"下载音频文件失败: {await response.text()}")
+        async with aiofiles.open(output_file, "wb") as f:
+            async for chunk in response.content.iter_any():
+                await f.write(chunk)
+
+
+# 已确认存在的输出目录，避免每次调用都 stat/mkdir
+_KNOWN_DIRS = set()
+
+
+def _ensure_dir(path):
+    if path not in _KNOWN_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _KNOWN_DIRS.add(path)
+
+
+def _local_output_path(endpoint, subfolder, filename):
+    """ComfyUI 在本机且配置了 COMFYUI_OUTPUT_DIR 时，返回生成文件的本地路径。"""
+    output_dir = os.environ.get("COMFYUI_OUTPUT_DIR")
+    if not output_dir:
+        return None
+    host = urlparse(endpoint).hostname
+    if host != "localhost":
+        try:
+            if not ipaddress.ip_address(host).is_loopback:
+                return None
+        except ValueError:
+            return None
+    src = os.path.join(output_dir, subfolder, filename)
+    return src if os.path.isfile(src) else None
+
+
+def _link_or_copy(src, dst):
+    """硬链接 (零拷贝) src 到 dst，跨设备时退回复制。成功返回 True。"""
+    try:
+        if os.path.exists(dst):
+            if os.path.samefile(src, dst):
+                return True
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+        return True
+    except OSError as e:
+        print(f"本地复制音频失败，改为 HTTP 下载: {e}")
+        return False
 
 
 async def generate_audio(tags: str, lyrics: str, duration: int, comfyui_endpoint :str ,workflow_file :str) -> str:
@@ -18,65 +254,103 @@ async def generate_audio(tags: str, lyrics: str, duration: int, comfyui_endpoint
     WORKFLOW_FILE = workflow_file
 
 
-    # 读取工作流文件
-    with open(WORKFLOW_FILE, "r", encoding="utf-8") as f:
-        workflow_data = json.load(f)
+    # 读取工作流文件 (按路径 + 修改时间缓存解析结果)
+    mtime = os.stat(WORKFLOW_FILE).st_mtime_ns
+    entry = _WF_CACHE.get(WORKFLOW_FILE)
+    if entry is None or entry[0] != mtime:
+        # 缓存未命中时异步读取并在线程中解析，不阻塞事件循环
+        async with aiofiles.open(WORKFLOW_FILE, "rb") as f:
+            raw = await f.read()
+        template = await asyncio.to_thread(_json_loads, raw)
+        entry = (mtime, template, template["14"]["inputs"], template["17"]["inputs"])
+        _WF_CACHE[WORKFLOW_FILE] = entry
+    _, workflow_data, tags_inputs, duration_inputs = entry
 
-    # 修改工作流中的歌词、风格标签和时长
-    workflow_data["14"]["inputs"]["tags"] = tags
-    workflow_data["14"]["inputs"]["lyrics"] = lyrics
-    workflow_data["17"]["inputs"]["seconds"] = duration  # 设置音频时长
+    client_id = uuid.uuid4().hex
+
+    # 直接改写缓存模板中的歌词、风格标签和时长并立即序列化。
+    # 改写与序列化之间没有 await，并发的调用不会读到彼此的参数
+    tags_inputs["tags"] = tags
+    tags_inputs["lyrics"] = lyrics
+    duration_inputs["seconds"] = duration  # 设置音频时长
+    payload = _json_dumps({"prompt": workflow_data, "client_id": client_id})
 
     # 提交工作流到 ComfyUI
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{COMFYUI_ENDPOINT}/prompt",
-            json={"prompt": workflow_data}
-        ) as response:
-            if response.status != 200:
-                raise Exception(f"提交工作流失败: {await response.text()}")
-            response_data = await response.json()
-            prompt_id = response_data["prompt_id"]
-            print(f"任务已提交，任务 ID: {prompt_id}")
-
-        # 轮询任务状态
-        print("等待完成，3 秒查询一次...")
-        while True:
-            await asyncio.sleep(3)
-            async with session.get(f"{COMFYUI_ENDPOINT}/history/{prompt_id}") as poll_response:
-                if poll_response.status == 200:
-                    poll_data = await poll_response.json()
-                    if poll_data.get(prompt_id, {}).get("status", {}).get("completed", False):
-                        break
-                # print(".", end="", flush=True)
-
-        # 获取生成的音频文件信息
-        outputs = poll_data[prompt_id].get("outputs", {})
-        if "59" not in outputs or "audio" not in outputs["59"]:
-            raise KeyError(f"'audio' 不存在于响应的 'outputs' 中: {outputs}")
-
-        # 提取音频信息
-        audio_info = outputs["59"]["audio"][0]
-        filename = audio_info["filename"]
-        subfolder = audio_info["subfolder"]
-        audio_url = f"{COMFYUI_ENDPOINT}/view?filename={filename}&subfolder={subfolder}&type=output"
-
-        # 下载音频文件
-        async with session.get(audio_url) as audio_response:
-            if audio_response.status != 200:
-                raise Exception(f"下载音频文件失败: {await audio_response.text()}")
-            audio_data = await audio_response.read()
-
-        # 保存音频文件
-        output_file = os.path.join(subfolder, filename)
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, "wb") as f:
-            f.write(audio_data)
+    session = await _get_session()
+    # 先订阅 WebSocket 事件，任务完成时立即得到通知
+    ws = None
+    try:
+        ws = await asyncio.wait_for(
+            session.ws_connect(f"{COMFYUI_ENDPOINT}/ws?clientId={client_id}"), _WS_CONNECT_TIMEOUT
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"WebSocket 连接失败，改为轮询: {e or type(e).__name__}")
+
+    try:
+        prompt_id = await _retry(
+            lambda: _submit(session, COMFYUI_ENDPOINT, payload), retry_on=_CONNECT_ERRORS
+        )
+        print(f"任务已提交，任务 ID: {prompt_id}")
+
+        # 不设总时长上限：排队时间取决于 ComfyUI 队列长度 (批量提交时尤甚)，
+        # 超时放弃也不会取消服务器上的任务
+        print("等待完成...")
+        if ws is not None:
+            await _wait_ws_done(ws, prompt_id)
+    finally:
+        if ws is not None:
+            await ws.close()
+
+    # 查询任务结果 (WebSocket 不可用时即为轮询)
+    poll_data = await _poll_history(session, COMFYUI_ENDPOINT, prompt_id)
+
+    # 获取生成的音频文件信息
+    outputs = poll_data[prompt_id].get("outputs", {})
+    if "59" not in outputs or "audio" not in outputs["59"]:
+        raise KeyError(f"'audio' 不存在于响应的 'outputs' 中: {outputs}")
+
+    # 提取音频信息
+    audio_info = outputs["59"]["audio"][0]
+    filename = audio_info["filename"]
+    subfolder = audio_info["subfolder"]
+    # 由 yarl 负责转义，非 ASCII 文件名也能正确请求
+    audio_url = URL(COMFYUI_ENDPOINT).joinpath("view").with_query(
+        filename=filename, subfolder=subfolder, type="output"
+    )
+
+    output_file = os.path.join(subfolder, filename)
+    _ensure_dir(os.path.dirname(output_file) or ".")
+
+    # ComfyUI 在本机时直接从其输出目录取文件，省去 HTTP 下载
+    local_src = _local_output_path(COMFYUI_ENDPOINT, subfolder, filename)
+    if local_src and await asyncio.to_thread(_link_or_copy, local_src, output_file):
         print(f"音频已成功保存到 {output_file}")
         return output_file
 
+    await _retry(lambda: _download(session, audio_url, output_file))
+    print(f"音频已成功保存到 {output_file}")
+    return output_file
+
+
+async def generate_audio_batch(specs, concurrency: int = 4) -> list:
+    """
+    并发生成多首音频，最多同时提交 concurrency 个任务。
+
+    specs 为 generate_audio 的关键字参数字典列表，返回值顺序与 specs 一致；
+    单个任务失败时对应位置为异常对象，不影响其他任务。
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(spec):
+        async with sem:
+            return await generate_audio(**spec)
+
+    return await asyncio.gather(*(one(s) for s in specs), return_exceptions=True)
+
 # 示例调用
 if __name__ == "__main__":
+    comfyui_endpoint = os.getenv("COMFYUI_ENDPOINT", "http://127.0.0.1:8188")
+    workflow_file = os.getenv("COMFYUI_WORKFLOW", "workflow.json")
     tags = "pop, multilingual, emotional, duet, chinese, english"
     lyrics = """
     [verse]
@@ -110,4 +384,18 @@ if __name__ == "__main__":
     [zh]zaizhewujin4deye4wan3,wo3zong3neng2zhao3dao4ni3
     """
     duration = 180  # 设置音频时长为 300 秒（5 分钟）
-    asyncio.run(generate_audio(tags, lyrics, duration, comfyui_endpoint, workflow_file))
+
+    async def _demo():
+        await warmup(comfyui_endpoint)
+        try:
+            await generate_audio(tags, lyrics, duration, comfyui_endpoint, workflow_file)
+        finally:
+            await close_session()
+
+    # 单独运行时可用 uvloop 加速事件循环；作为插件加载时沿用 AstrBot 的事件循环，不做替换
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(_demo())
+    else:
+        uvloop.run(_demo())
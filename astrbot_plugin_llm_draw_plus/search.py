@@ -1,22 +1,79 @@
-from duckduckgo_search import DDGS
-
-proxy = "http://43.131.5.106:3698"
-
-try:
-    ddgs = DDGS(proxy=proxy)
-    keywords = "人工智能"
-    results = ddgs.text(keywords, max_results=5)
-
-    if results:
-        print(f"搜索 '{keywords}' 的结果:")
-        for i, r in enumerate(results):
-            print(f"--- 结果 {i+1} ---")
-            print(f"标题: {r['title']}")
-            print(f"链接: {r['href']}")
-            print(f"摘要: {r['body']}")
-            print("-" * 20)
-    else:
-        print("没有找到任何结果。")
-
-except Exception as e:
-    print(f"发生错误: {e}")
\ No newline at end of file
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 默认代理取自环境变量，未设置时直连
+DEFAULT_PROXY = os.environ.get("HTTPS_PROXY")
+
+
+class _SearchCache:
+    """线程安全的 LRU + TTL 搜索结果缓存。"""
+
+    def __init__(self, maxsize=512, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            hit = self._data.get(key)
+            if hit and now - hit[0] < self.ttl:
+                self._data.move_to_end(key)
+                return hit[1]
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_cache = _SearchCache()
+
+
+def _text(keywords, max_results, proxy):
+    key = (keywords, max_results)
+    results = _cache.get(key)
+    if results is None:
+        # 延迟导入，import 本模块时不加载 duckduckgo_search
+        from duckduckgo_search import DDGS
+
+        results = DDGS(proxy=proxy).text(keywords, max_results=max_results)
+        _cache.put(key, results)
+    return results
+
+
+async def search_many(keywords_list, max_results=5, proxy=None):
+    """并发搜索多个关键词，返回结果顺序与输入一致。proxy 为空时使用模块默认代理。"""
+    proxy = proxy or DEFAULT_PROXY
+    return await asyncio.gather(*(asyncio.to_thread(_text, k, max_results, proxy) for k in keywords_list))
+
+
+def main():
+    try:
+        keywords = "人工智能"
+        results = asyncio.run(search_many([keywords], max_results=5))[0]
+
+        if results:
+            print(f"搜索 '{keywords}' 的结果:")
+            for i, r in enumerate(results):
+                print(f"--- 结果 {i+1} ---")
+                print(f"标题: {r['title']}")
+                print(f"链接: {r['href']}")
+                print(f"摘要: {r['body']}")
+                print("-" * 20)
+        else:
+            print("没有找到任何结果。")
+
+    except Exception as e:
+        print(f"发生错误: {e}")
+
+
+if __name__ == "__main__":
+    main()
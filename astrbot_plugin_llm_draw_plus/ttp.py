@@ -7,10 +7,227 @@ import asyncio
 import aiofiles
 import base64
 import re
-from PIL import Image
+import os
+import logging
+import struct
+import tempfile
+import itertools
+from functools import lru_cache
 from io import BytesIO
 from astrbot.api import logger
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib
+    orjson = None
+
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+try:
+    import pybase64 as _b64
+except ImportError:  # pybase64 (SIMD base64) is optional; same API as the stdlib module
+    _b64 = base64
+
+_DEBUG_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "debug.log")
+_DEBUG_LOG_LIMIT = 4096
+
+# Patterns used on every call, compiled once at import
+_MD_IMG_RE = re.compile(r'!\[.*?\]\((https?://.*?)\)')
+_VIDEO_SRC_RE = re.compile(r"<video[^>]+src=['\"](https?://[^'\"]+)['\"]")
+_URL_RE = re.compile(r'(https?://[^\s)"\'<>]+)')
+_AR_RE = re.compile(r'--ar\s+(\d+:\d+)')
+_RES_RE = re.compile(r'--(1k|2k|4k)', re.IGNORECASE)
+
+_JPEG_DATA_PREFIX = "data:image/jpeg;base64,"
+
+# Aspect ratios Gemini accepts, with their numeric value for nearest-match lookup
+_GEMINI_RATIOS = (
+    ("1:1", 1.0),
+    ("2:3", 2/3), ("3:2", 3/2),
+    ("3:4", 3/4), ("4:3", 4/3),
+    ("4:5", 4/5), ("5:4", 5/4),
+    ("9:16", 9/16), ("16:9", 16/9),
+    ("21:9", 21/9),
+)
+_GEMINI_RATIO_NAMES = frozenset(name for name, _ in _GEMINI_RATIOS)
+
+@lru_cache(maxsize=32)
+def _gemini_generation_config(aspect_ratio, resolution, is_flash):
+    # Shared between calls (only ever serialized), so callers must not mutate the result
+    generation_config = {
+        "responseModalities": ["TEXT", "IMAGE"]
+    }
+
+    image_config = {}
+    if aspect_ratio:
+        image_config["aspectRatio"] = aspect_ratio
+    if resolution and not is_flash:
+        image_config["imageSize"] = resolution
+
+    if image_config:
+        generation_config["imageConfig"] = image_config
+    return generation_config
+
+# Shared keep-alive pool for Flow2API/Gemini calls and image downloads, closed from the plugin's terminate()
+_SESSION = None
+
+def _get_session():
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        # trust_env keeps honouring HTTP(S)_PROXY like the previous curl call did
+        connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+        _SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600), connector=connector, trust_env=True)
+    return _SESSION
+
+# Flow2API streams (Veo video jobs especially) can run well past 10 minutes, so they get an
+# idle limit between reads instead of the session's total limit
+_FLOW_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+
+async def close_session():
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
+# Per-call output files so concurrent generations don't overwrite each other. The counter is
+# unbounded per process; main.py's _discard_image deletes each file once it has been sent.
+_image_seq = itertools.count()
+
+def _image_ext(data):
+    # Pick the file extension from the magic bytes so PNG/GIF/WebP results aren't labelled .jpeg
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return ".png"
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return ".gif"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return ".webp"
+    return ".jpeg"
+
+def _new_image_path(data):
+    n = next(_image_seq)
+    return os.path.join(tempfile.gettempdir(), f"zenith_{os.getpid()}_{n}{_image_ext(data)}")
+
+_BE_H = struct.Struct('>H')
+_BE_HH = struct.Struct('>HH')
+_BE_II = struct.Struct('>II')
+_LE_HH = struct.Struct('<HH')
+
+def _sniff_size(data):
+    # Read (width, height) straight from a JPEG/PNG/GIF/WebP header without decoding; None if unrecognised
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR' and len(data) >= 24:
+        return _BE_II.unpack_from(data, 16)
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return _LE_HH.unpack_from(data, 6)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8 ':
+            w, h = _LE_HH.unpack_from(data, 26)
+            return w & 0x3FFF, h & 0x3FFF
+        if chunk == b'VP8L':
+            bits = int.from_bytes(data[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':
+            return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+        return None
+    if data[:2] == b'\xff\xd8':
+        # Walk the marker segments up to the first SOFn (skipping DHT/JPG/DAC, which share the range)
+        i, n = 2, len(data)
+        while i + 9 <= n:
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                i += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = _BE_HH.unpack_from(data, i + 5)
+                return w, h
+            i += 2 + _BE_H.unpack_from(data, i + 2)[0]
+    return None
+
+def _probe_size(image_data):
+    # Fallback for formats the header sniffer doesn't know
+    from PIL import Image
+    try:
+        with BytesIO(image_data) as buf, Image.open(buf) as img:
+            return f"{img.width}x{img.height}"
+    except Exception:
+        return "Unknown"
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+async def _write_bytes(path, data):
+    # One worker-thread hop for open+write+close, where aiofiles needs one per call
+    await asyncio.to_thread(_write_file, path, data)
+
+async def _save_and_probe(image_path, image_data):
+    size = _sniff_size(image_data)
+    if size:
+        await _write_bytes(image_path, image_data)
+        return f"{size[0]}x{size[1]}"
+    # Unknown header: write the image and let PIL read its dimensions concurrently in a worker thread
+    _, real_size = await asyncio.gather(
+        _write_bytes(image_path, image_data),
+        asyncio.to_thread(_probe_size, image_data),
+    )
+    return real_size
+
+async def _download_result(image_url, label):
+    # Download a generated image to a local file; the URL is kept so callers can send it directly
+    try:
+        async with _get_session().get(image_url) as img_response:
+            if img_response.status != 200:
+                return None, None, None, f"{label} generated URL but download failed: {img_response.status}"
+            image_data = await img_response.read()
+        image_path = _new_image_path(image_data)
+        real_size = await _save_and_probe(image_path, image_data)
+        return image_url, image_path, real_size, None
+    except Exception as e:
+        logger.error(f"Failed to download {label} image: {e}")
+        return None, None, None, f"{label} download exception: {e}"
+
+async def _save_data_uri(data_uri):
+    # Decode a base64 data URI to a local file; None as URL forces callers to use the file path
+    try:
+        image_data = _b64.b64decode(data_uri[data_uri.index(',') + 1:])
+        image_path = _new_image_path(image_data)
+        real_size = await _save_and_probe(image_path, image_data)
+        return None, image_path, real_size, None
+    except Exception as e:
+        logger.error(f"Failed to decode base64 image: {e}")
+        return None, None, None, f"Failed to decode base64 image: {e}"
+
+async def _finalize_result(result, label):
+    # Turn a call_flow2api result into (image_url, image_path, real_size, error)
+    if result.startswith("http"):
+        return await _download_result(result, label)
+    if result.startswith("data:image"):
+        return await _save_data_uri(result)
+    return None, None, None, f"{label} error: {result}"
+
+def _image_url_parts(input_images_b64):
+    # OpenAI-style image_url content parts; bare base64 input is assumed to be JPEG
+    return [
+        {"type": "image_url", "image_url": {"url": b64 if b64.startswith("data:") else _JPEG_DATA_PREFIX + b64}}
+        for b64 in input_images_b64
+    ]
+
+@lru_cache(maxsize=128)
 def get_model_suffix(aspect_ratio, image_size, separator="-"):
     # Default to landscape if nothing provided, as per supported models list
     # Supported: landscape, portrait. Square is not explicitly listed, mapping 1:1 to landscape.
@@ -28,7 +245,7 @@ def get_model_suffix(aspect_ratio, image_size, separator="-"):
                 w, h = map(int, aspect_ratio.split(':'))
                 if h > w:
                     target = "portrait"
-            except:
+            except ValueError:
                 pass
     elif image_size:
         try:
@@ -36,15 +253,57 @@ def get_model_suffix(aspect_ratio, image_size, separator="-"):
                 w, h = map(int, image_size.lower().split('x'))
                 if h > w:
                     target = "portrait"
-        except:
+        except ValueError:
             pass
     
     return f"{separator}{target}"
 
+async def _iter_lines(stream):
+    # aiohttp's readline() caps a line at its buffer high-water mark, but a
+    # single SSE line can carry a multi-MB base64 image, so split manually.
+    buf = bytearray()
+    async for chunk in stream.iter_any():
+        scan = len(buf)
+        buf += chunk
+        start = 0
+        while (nl := buf.find(b"\n", scan)) != -1:
+            yield bytes(buf[start:nl])
+            start = scan = nl + 1
+        del buf[:start]
+    if buf:
+        yield bytes(buf)
+
+def _parse_sse_line(line, content_parts):
+    # Returns the image URL if this SSE line carries one, otherwise collects its text into content_parts
+    line = line.strip()
+    if not line.startswith(b'data: ') or line == b'data: [DONE]':
+        return None
+    try:
+        chunk = _json_loads(line[6:])
+    except ValueError:
+        return None
+    if 'choices' in chunk and len(chunk['choices']) > 0:
+        delta = chunk['choices'][0].get('delta', {})
+        content = delta.get('content', '')
+        if content:
+            content_parts.append(content)
+
+        # Check for 'images' in delta (Gemini/Flow specific in SSE)
+        # Take the LAST image for highest resolution
+        images = delta.get('images', [])
+        if images and len(images) > 0:
+            image_url = images[-1].get('image_url', {}).get('url')
+            if image_url:
+                return image_url
+
+        reasoning = delta.get('reasoning_content', '')
+        if reasoning:
+            logger.info(f"Flow2API Reasoning: {reasoning}")
+            if "❌" in reasoning or "Error" in reasoning or "失败" in reasoning:
+                content_parts.append(f"\n[Reasoning Error]: {reasoning}")
+    return None
+
 async def call_flow2api(url, token, payload):
-    # Final approach: Use curl via subprocess to bypass potential aiohttp/env issues
-    # Use temporary file for payload to avoid "Argument list too long" error with large base64 images
-    
     headers = {
         "Content-Type": "application/json"
     }
@@ -53,157 +312,105 @@ async def call_flow2api(url, token, payload):
 
     # payload["stream"] = True # Removed: Do not force stream=True, respect caller's setting
 
-    logger.info(f"Calling Flow2API via curl: {url} with model {payload.get('model')}")
+    logger.info(f"Calling Flow2API: {url} with model {payload.get('model')}")
 
-    # Create a temporary file for payload
-    import tempfile
-    import os
-    
     try:
-        fd, temp_path = tempfile.mkstemp(suffix=".json", text=True)
-        response_text = ""
-        try:
-            with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                json.dump(payload, f)
-                
-            # Prepare curl command using @file syntax
-            headers_str = " ".join([f"-H '{k}: {v}'" for k, v in headers.items()])
-            temp_path_curl = temp_path.replace('\\', '/')
-            
-            # Use --no-buffer to ensure we get output as it comes (though communicate waits for all)
-            # Quote the file path to handle potential spaces or special chars
-            # On Windows cmd.exe, single quotes are NOT supported. Use double quotes.
-            # However, we're using create_subprocess_shell below, which uses the system shell.
-            # Safest is to use double quotes around the URL and the @path, and handle headers carefully.
-            # But converting headers to a string with quotes is tricky cross-platform.
-            # Let's switch to list arguments + create_subprocess_exec to avoid shell quoting hell.
-            
-            # NOTE: Previous implementation used shell=True and manual string formatting.
-            # Switching to list args is safer and cleaner.
-            
-            curl_args = ["curl", "-X", "POST", url, "--no-buffer"]
-            for k, v in headers.items():
-                curl_args.extend(["-H", f"{k}: {v}"])
-            
-            # curl supports @filename
-            curl_args.extend(["-d", f"@{temp_path}"])
-            
-            # logger.info(f"Executing curl command: {' '.join(curl_args)}") # Masked for security if needed
-
-            proc = await asyncio.create_subprocess_exec(
-                *curl_args,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-
-            stdout, stderr = await proc.communicate()
-
-            if proc.returncode != 0:
-                err_msg = stderr.decode().strip()
-                logger.error(f"Curl command failed with code {proc.returncode}: {err_msg}")
-                if stdout:
-                    logger.error(f"Curl stdout: {stdout.decode().strip()}")
-                return f"Error: Curl failed - {err_msg}"
-
-            response_text = stdout.decode().strip()
-        finally:
-            if os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
-        
+        full_content = ""
+        content_parts = []
+
+        async with _get_session().post(url, data=_json_dumps(payload), headers=headers, timeout=_FLOW_TIMEOUT) as response:
+            if response.content_type == "text/event-stream":
+                # Parse the stream as it arrives and return as soon as an image shows up
+                async for line in _iter_lines(response.content):
+                    image_url = _parse_sse_line(line, content_parts)
+                    if image_url:
+                        # Drop the connection rather than draining (or pooling) the rest of the stream
+                        response.close()
+                        return image_url
+                response_body = None
+                response_text = "".join(content_parts)
+                response_len = len(response_text)
+            else:
+                # Keep the body as bytes: the JSON parser takes bytes directly, so a multi-MB
+                # base64 response is never decoded as a whole; only the logged head is
+                response_body = (await response.read()).strip()
+                response_text = response_body[:2000].decode("utf-8", "replace")
+                response_len = len(response_body)
+
         # Log full response for debugging
-        if len(response_text) < 2000:
-            logger.info(f"Curl Response: {response_text}")
+        if response_len < 2000:
+            logger.info(f"Flow2API Response: {response_text}")
         else:
-            logger.info(f"Curl Response (first 2000 chars): {response_text[:2000]}")
+            logger.info(f"Flow2API Response (first 2000 chars): {response_text[:2000]}")
 
-        # Write debug log to file
-        try:
-            log_dir = os.path.dirname(os.path.abspath(__file__))
-            log_path = os.path.join(log_dir, "debug.log")
-            with open(log_path, "a", encoding="utf-8") as f:
-                f.write(f"\n--- {time.strftime('%Y-%m-%d %H:%M:%S')} ---\n")
-                f.write(f"URL: {url}\n")
-                f.write(f"Response:\n{response_text}\n")
-        except Exception as e:
-            logger.warning(f"Failed to write debug log: {e}")
+        # Write debug log to file (debug level only, response capped so base64 payloads don't bloat it)
+        if logger.isEnabledFor(logging.DEBUG):
+            try:
+                raw = response_body if response_body is not None else response_text.encode("utf-8")
+                async with aiofiles.open(_DEBUG_LOG_PATH, "ab") as f:
+                    await f.write(
+                        f"\n--- {time.strftime('%Y-%m-%d %H:%M:%S')} ---\nURL: {url}\nResponse:\n".encode("utf-8")
+                        + raw[:_DEBUG_LOG_LIMIT]
+                        + (b"...(truncated)\n" if len(raw) > _DEBUG_LOG_LIMIT else b"\n")
+                    )
+            except Exception as e:
+                logger.warning(f"Failed to write debug log: {e}")
 
-        full_content = ""
-        
-        # 1. Try parsing as standard JSON first (Non-streaming error or success)
-        try:
-            data_json = json.loads(response_text)
-            if 'error' in data_json:
-                error_detail = data_json['error']
-                if isinstance(error_detail, dict) and 'message' in error_detail:
-                    return f"Error from API: {error_detail['message']}"
-                return f"Error from API: {data_json['error']}"
-            
-            # Check for standard chat completion response
-            if 'choices' in data_json and len(data_json['choices']) > 0:
-                message = data_json['choices'][0].get('message', {})
-                content = message.get('content', '')
-                if content:
-                    full_content = content
-                
-                # Check for non-standard 'images' field in message (Gemini/Flow specific)
-                # Gemini returns multiple images (1K and 2K), take the LAST one (highest resolution)
-                images = message.get('images', [])
-                if images and len(images) > 0:
-                    image_url = images[-1].get('image_url', {}).get('url')
+        if response_body is None:
+            # Streamed SSE already parsed above
+            full_content = response_text
+        else:
+            # 1. Try parsing as standard JSON first (Non-streaming error or success)
+            try:
+                data_json = _json_loads(response_body)
+                if 'error' in data_json:
+                    error_detail = data_json['error']
+                    if isinstance(error_detail, dict) and 'message' in error_detail:
+                        return f"Error from API: {error_detail['message']}"
+                    return f"Error from API: {data_json['error']}"
+
+                # Check for standard chat completion response
+                if 'choices' in data_json and len(data_json['choices']) > 0:
+                    message = data_json['choices'][0].get('message', {})
+                    content = message.get('content', '')
+                    if content:
+                        full_content = content
+
+                    # Check for non-standard 'images' field in message (Gemini/Flow specific)
+                    # Gemini returns multiple images (1K and 2K), take the LAST one (highest resolution)
+                    images = message.get('images', [])
+                    if images and len(images) > 0:
+                        image_url = images[-1].get('image_url', {}).get('url')
+                        if image_url:
+                            return image_url
+
+                # Check for image generation response (DALL-E style)
+                elif 'data' in data_json and len(data_json['data']) > 0:
+                    url_res = data_json['data'][0].get('url')
+                    if url_res:
+                        return url_res
+            except ValueError:
+                # Not a simple JSON object (or not valid UTF-8), likely SSE stream or raw text
+                pass
+
+            # 2. If not standard JSON, try parsing as SSE stream (server did not label it text/event-stream)
+            if not full_content:
+                for line in response_body.splitlines():
+                    image_url = _parse_sse_line(line, content_parts)
                     if image_url:
                         return image_url
-
-            # Check for image generation response (DALL-E style)
-            elif 'data' in data_json and len(data_json['data']) > 0:
-                url_res = data_json['data'][0].get('url')
-                if url_res:
-                    return url_res
-        except json.JSONDecodeError:
-            # Not a simple JSON object, likely SSE stream or raw text
-            pass
-
-        # 2. If not standard JSON, try parsing as SSE stream
-        if not full_content:
-            for line in response_text.splitlines():
-                line = line.strip()
-                if line.startswith('data: ') and line != 'data: [DONE]':
-                    json_str = line[6:]
-                    try:
-                        chunk = json.loads(json_str)
-                        if 'choices' in chunk and len(chunk['choices']) > 0:
-                            delta = chunk['choices'][0].get('delta', {})
-                            content = delta.get('content', '')
-                            if content:
-                                full_content += content
-                            
-                            # Check for 'images' in delta (Gemini/Flow specific in SSE)
-                            # Take the LAST image for highest resolution
-                            images = delta.get('images', [])
-                            if images and len(images) > 0:
-                                image_url = images[-1].get('image_url', {}).get('url')
-                                if image_url:
-                                    return image_url
-                            
-                            reasoning = delta.get('reasoning_content', '')
-                            if reasoning:
-                                logger.info(f"Flow2API Reasoning: {reasoning}")
-                                if "❌" in reasoning or "Error" in reasoning or "失败" in reasoning:
-                                    full_content += f"\n[Reasoning Error]: {reasoning}"
-                    except json.JSONDecodeError:
-                        pass
+                full_content = "".join(content_parts)
 
         # URL Extraction logic remains the same
-        md_match = re.search(r'!\[.*?\]\((https?://.*?)\)', full_content)
+        md_match = _MD_IMG_RE.search(full_content)
         if md_match:
             return md_match.group(1)
         
-        video_match = re.search(r"<video[^>]+src=['\"](https?://[^'\"]+)['\"]", full_content)
+        video_match = _VIDEO_SRC_RE.search(full_content)
         if video_match:
             return video_match.group(1)
 
-        url_match = re.search(r'(https?://[^\s)"\'<>]+)', full_content)
+        url_match = _URL_RE.search(full_content)
         if url_match:
             return url_match.group(1)
         
@@ -220,7 +427,7 @@ async def call_flow2api(url, token, payload):
         return "Empty response from Flow2API"
 
     except Exception as e:
-        logger.error(f"Subprocess/Curl execution exception: {e}")
+        logger.error(f"Flow2API request exception: {e}")
         return f"Exception: {e}"
 
 async def generate_image(prompt, google_api_key=None, model=None, image_size="1024x1024", input_images_b64: list = None, resolution=None, aspect_ratio=None, flow_api_url=None, flow_api_token=None, provider=None, seed=None):
@@ -251,12 +458,7 @@ async def generate_image(prompt, google_api_key=None, model=None, image_size="10
         
         # Add images if any
         if input_images_b64:
-            for b64 in input_images_b64:
-                img_url = b64 if b64.startswith("data:") else f"data:image/jpeg;base64,{b64}"
-                user_content.append({
-                    "type": "image_url",
-                    "image_url": {"url": img_url}
-                })
+            user_content.extend(_image_url_parts(input_images_b64))
 
         # Add text prompt
         # Enforce image generation instruction to prevent model from just chatting
@@ -297,63 +499,13 @@ async def generate_image(prompt, google_api_key=None, model=None, image_size="10
             result = await call_flow2api(flow_api_url, flow_api_token, payload)
             
             if result:
-                if result.startswith("http"):
-                    image_url = result
-                    # Download to local path
-                    try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(image_url) as img_response:
-                                if img_response.status == 200:
-                                    image_path = 'downloaded_image.jpeg'
-                                    image_data = await img_response.read()
-                                    async with aiofiles.open(image_path, 'wb') as f:
-                                        await f.write(image_data)
-                                    
-                                    # Get real image size
-                                    real_size = "Unknown"
-                                    try:
-                                        with Image.open(BytesIO(image_data)) as img:
-                                            real_size = f"{img.width}x{img.height}"
-                                    except Exception: pass
-    
-                                    # Construct detailed source info
-                                    source_info = f"OpenAI Compatible ({model})"
-                                    source_info += f" | AR: {aspect_ratio if aspect_ratio else 'Default'}"
-                                    source_info += f" | Res: {resolution if resolution else 'Default'} ({real_size})"
-                                    return image_url, image_path, source_info
-                                else:
-                                    flow_error = f"OpenAI API generated URL but download failed: {img_response.status}"
-                    except Exception as e:
-                        flow_error = f"OpenAI API download exception: {e}"
-                        logger.error(f"Failed to download OpenAI API image: {e}")
-                elif result.startswith("data:image"):
-                    # Handle base64 data URI directly
-                    try:
-                        # Extract base64 part
-                        header, b64_data = result.split(',', 1)
-                        image_data = base64.b64decode(b64_data)
-                        image_path = 'downloaded_image.jpeg'
-                        async with aiofiles.open(image_path, 'wb') as f:
-                            await f.write(image_data)
-                        # Return None as URL to force using file path
-                        
-                        # Get real image size
-                        real_size = "Unknown"
-                        try:
-                            with Image.open(BytesIO(image_data)) as img:
-                                real_size = f"{img.width}x{img.height}"
-                        except Exception: pass
-
-                        # Construct detailed source info
-                        source_info = f"OpenAI Compatible ({model})"
-                        source_info += f" | AR: {aspect_ratio if aspect_ratio else 'Default'}"
-                        source_info += f" | Res: {resolution if resolution else 'Default'} ({real_size})"
-                        return None, image_path, source_info
-                    except Exception as e:
-                        flow_error = f"Failed to decode base64 image: {e}"
-                        logger.error(f"Failed to decode base64 image: {e}")
-                else:
-                    flow_error = f"OpenAI API error: {result}"
+                image_url, image_path, real_size, flow_error = await _finalize_result(result, "OpenAI API")
+                if image_path:
+                    # Construct detailed source info
+                    source_info = f"OpenAI Compatible ({model})"
+                    source_info += f" | AR: {aspect_ratio if aspect_ratio else 'Default'}"
+                    source_info += f" | Res: {resolution if resolution else 'Default'} ({real_size})"
+                    return image_url, image_path, source_info
             else:
                 flow_error = f"OpenAI API error: Empty result"
         except Exception as e:
@@ -389,12 +541,7 @@ async def generate_image(prompt, google_api_key=None, model=None, image_size="10
         
         # Add images if any (Images first is often better for multimodal context)
         if input_images_b64:
-            for b64 in input_images_b64:
-                img_url = b64 if b64.startswith("data:") else f"data:image/jpeg;base64,{b64}"
-                user_content.append({
-                    "type": "image_url",
-                    "image_url": {"url": img_url}
-                })
+            user_content.extend(_image_url_parts(input_images_b64))
 
         # Add text prompt
         user_content.append({"type": "text", "text": prompt})
@@ -411,57 +558,11 @@ async def generate_image(prompt, google_api_key=None, model=None, image_size="10
             result = await call_flow2api(flow_api_url, flow_api_token, payload)
             
             if result:
-                if result.startswith("http"):
-                    image_url = result
-                    # Download to local path to be consistent with other return types
-                    try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(image_url) as img_response:
-                                if img_response.status == 200:
-                                    image_path = 'downloaded_image.jpeg'
-                                    image_data = await img_response.read()
-                                    async with aiofiles.open(image_path, 'wb') as f:
-                                        await f.write(image_data)
-                                    
-                                    # Get real image size
-                                    real_size = "Unknown"
-                                    try:
-                                        with Image.open(BytesIO(image_data)) as img:
-                                            real_size = f"{img.width}x{img.height}"
-                                    except Exception: pass
-    
-                                    source_info = f"Flow2API ({flow_model})"
-                                    source_info += f" | AR: {aspect_ratio if aspect_ratio else 'Default'} ({real_size})"
-                                    return image_url, image_path, source_info
-                                else:
-                                    flow_error = f"Flow2API generated URL but download failed: {img_response.status}"
-                    except Exception as e:
-                        flow_error = f"Flow2API download exception: {e}"
-                        logger.error(f"Failed to download Flow2API image: {e}")
-                elif result.startswith("data:image"):
-                    # Handle base64 data URI directly
-                    try:
-                        header, b64_data = result.split(',', 1)
-                        image_data = base64.b64decode(b64_data)
-                        image_path = 'downloaded_image.jpeg'
-                        async with aiofiles.open(image_path, 'wb') as f:
-                            await f.write(image_data)
-                        
-                        # Get real image size
-                        real_size = "Unknown"
-                        try:
-                            with Image.open(BytesIO(image_data)) as img:
-                                real_size = f"{img.width}x{img.height}"
-                        except Exception: pass
-
-                        source_info = f"Flow2API ({flow_model})"
-                        source_info += f" | AR: {aspect_ratio if aspect_ratio else 'Default'} ({real_size})"
-                        return None, image_path, source_info
-                    except Exception as e:
-                        flow_error = f"Failed to decode base64 image: {e}"
-                        logger.error(f"Failed to decode base64 image: {e}")
-                else:
-                    flow_error = f"Flow2API error: {result}"
+                image_url, image_path, real_size, flow_error = await _finalize_result(result, "Flow2API")
+                if image_path:
+                    source_info = f"Flow2API ({flow_model})"
+                    source_info += f" | AR: {aspect_ratio if aspect_ratio else 'Default'} ({real_size})"
+                    return image_url, image_path, source_info
             else:
                 flow_error = f"Flow2API error: Empty result"
         except Exception as e:
@@ -509,12 +610,7 @@ async def generate_video(prompt, model="veo_3_1_t2v_fast", input_images_b64: lis
 
     # Images (Start frame, End frame, etc.)
     if input_images_b64:
-        for b64 in input_images_b64:
-            img_url = b64 if b64.startswith("data:") else f"data:image/jpeg;base64,{b64}"
-            user_content.append({
-                "type": "image_url",
-                "image_url": {"url": img_url}
-            })
+        user_content.extend(_image_url_parts(input_images_b64))
     
     messages.append({"role": "user", "content": user_content})
     
@@ -546,11 +642,10 @@ async def generate_image_gemini(prompt, api_key, model, image_size, input_images
     if aspect_ratio:
         target_ratio = aspect_ratio
     else:
-        ar_match = re.search(r'--ar\s+(\d+:\d+)', prompt)
+        ar_match = _AR_RE.search(prompt)
         if ar_match:
             user_ratio = ar_match.group(1)
-            valid_ratios = ["1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9"]
-            if user_ratio in valid_ratios:
+            if user_ratio in _GEMINI_RATIO_NAMES:
                 target_ratio = user_ratio
                 prompt = prompt.replace(ar_match.group(0), "").strip()
         elif image_size:
@@ -558,21 +653,13 @@ async def generate_image_gemini(prompt, api_key, model, image_size, input_images
                 if "x" in image_size.lower():
                     w, h = map(int, image_size.lower().split('x'))
                     ratio = w / h
-                    ratios = {
-                        "1:1": 1.0,
-                        "2:3": 2/3, "3:2": 3/2,
-                        "3:4": 3/4, "4:3": 4/3,
-                        "4:5": 4/5, "5:4": 5/4,
-                        "9:16": 9/16, "16:9": 16/9,
-                        "21:9": 21/9
-                    }
-                    target_ratio = min(ratios, key=lambda k: abs(ratios[k] - ratio))
+                    target_ratio = min(_GEMINI_RATIOS, key=lambda item: abs(item[1] - ratio))[0]
             except Exception as e:
                 print(f"Error parsing image_size '{image_size}': {e}")
             
     target_resolution = resolution
     if not target_resolution:
-        res_match = re.search(r'--(1k|2k|4k)', prompt, re.IGNORECASE)
+        res_match = _RES_RE.search(prompt)
         if res_match:
             target_resolution = res_match.group(1).upper()
             prompt = prompt.replace(res_match.group(0), "").strip()
@@ -589,78 +676,62 @@ async def generate_image_gemini(prompt, api_key, model, image_size, input_images
                 }
             })
 
-    generation_config = {
-        "responseModalities": ["TEXT", "IMAGE"]
-    }
-    
-    image_config = {}
-    if target_ratio:
-        image_config["aspectRatio"] = target_ratio
-    if target_resolution and "flash" not in model.lower():
-        image_config["imageSize"] = target_resolution
-        
-    if image_config:
-        generation_config["imageConfig"] = image_config
+    generation_config = _gemini_generation_config(target_ratio, target_resolution, "flash" in model.lower())
 
     payload = {
         "contents": [{"parts": parts}],
         "generationConfig": generation_config
     }
     
-    timeout = aiohttp.ClientTimeout(total=600)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, json=payload) as response:
-            if response.status != 200:
-                error_msg = await response.text()
-                print(f"Gemini API Error: {error_msg}")
-                return None, f"Error: Gemini API request failed ({response.status}). {error_msg}"
-            
-            data = await response.json()
-            try:
-                candidates = data.get('candidates', [])
-                if candidates:
-                    parts = candidates[0].get('content', {}).get('parts', [])
-                    for part in parts:
-                        inline_data = part.get('inline_data') or part.get('inlineData')
-                        if inline_data:
-                            b64_data = inline_data.get('data')
-                            if b64_data:
-                                image_data = base64.b64decode(b64_data)
-                                image_path = 'downloaded_image.jpeg'
-                                async with aiofiles.open(image_path, 'wb') as f:
-                                    await f.write(image_data)
-                                
-                                # Get real image size (Though generate_image_gemini returns (url, path), not source info directly here?
-                                # Wait, generate_image_gemini returns (url, path). The source info is constructed in generate_image.
-                                # So we don't need to return it here, but we can't easily pass it back.
-                                # Let's check generate_image logic for Official API.
-                                print("Gemini image generated and saved.")
-                                return None, image_path
+    async with _get_session().post(url, data=_json_dumps(payload), headers=_JSON_HEADERS) as response:
+        if response.status != 200:
+            error_msg = await response.text()
+            print(f"Gemini API Error: {error_msg}")
+            return None, f"Error: Gemini API request failed ({response.status}). {error_msg}"
+        
+        data = _json_loads(await response.read())
+        try:
+            candidates = data.get('candidates', [])
+            if candidates:
+                parts = candidates[0].get('content', {}).get('parts', [])
+                for part in parts:
+                    inline_data = part.get('inline_data') or part.get('inlineData')
+                    if inline_data:
+                        b64_data = inline_data.get('data')
+                        if b64_data:
+                            image_data = _b64.b64decode(b64_data)
+                            image_path = _new_image_path(image_data)
+                            await _write_bytes(image_path, image_data)
                             
-            except Exception as e:
-                print(f"Error parsing Gemini response: {e}")
-                return None, f"Error parsing Gemini response: {e}"
-            
-            text_content = ""
-            try:
-                if 'candidates' in data and data['candidates']:
-                    parts = data['candidates'][0].get('content', {}).get('parts', [])
-                    for part in parts:
-                        if 'text' in part:
-                            text_content += part['text']
-            except:
-                pass
-            
-            if text_content and len(text_content) > 10:
-                 error_msg = f"Error: No image data found. Model Output: {text_content[:200]}"
-            else:
-                 debug_data = json.dumps(data, indent=2)
-                 if len(debug_data) > 1000:
-                     debug_data = debug_data[:1000] + "...(truncated)"
-                 error_msg = f"Error: No image data found. Full Debug: {debug_data}"
-            
-            print(error_msg)
-            return None, error_msg
+                            # Get real image size (Though generate_image_gemini returns (url, path), not source info directly here?
+                            # Wait, generate_image_gemini returns (url, path). The source info is constructed in generate_image.
+                            # So we don't need to return it here, but we can't easily pass it back.
+                            # Let's check generate_image logic for Official API.
+                            print("Gemini image generated and saved.")
+                            return None, image_path
+                        
+        except Exception as e:
+            print(f"Error parsing Gemini response: {e}")
+            return None, f"Error parsing Gemini response: {e}"
+        
+        text_content = ""
+        try:
+            if 'candidates' in data and data['candidates']:
+                parts = data['candidates'][0].get('content', {}).get('parts', [])
+                text_content = "".join(part['text'] for part in parts if 'text' in part)
+        except:
+            pass
+        
+        if text_content and len(text_content) > 10:
+             error_msg = f"Error: No image data found. Model Output: {text_content[:200]}"
+        else:
+             debug_data = json.dumps(data, indent=2)
+             if len(debug_data) > 1000:
+                 debug_data = debug_data[:1000] + "...(truncated)"
+             error_msg = f"Error: No image data found. Full Debug: {debug_data}"
+        
+        print(error_msg)
+        return None, error_msg
 
 if __name__ == "__main__":
     pass
\ No newline at end of file